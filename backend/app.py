@@ -1,9 +1,14 @@
-from flask import Flask, jsonify, render_template
+from flask import Flask, Response, jsonify, render_template
 from flask_cors import CORS
-from solver import solve_tsp
+from solver import solve_tsp, define_locations, define_parameters
+from concurrent.futures import Future
+import hashlib
+import json
 import logging
-import numpy as np
+import orjson
 import os
+import tempfile
+import threading
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -26,32 +31,113 @@ logging.basicConfig(
 # Retrieve the Google Maps API key from environment variables
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-# Run the TSP solver on startup and store the result
-try:
-    logging.info("Starting TSP solver...")
-    tsp_result = solve_tsp()
-    logging.info("TSP solver completed successfully.")
-except Exception as e:
-    logging.error(f"Error running TSP solver: {e}")
-    tsp_result = {"error": "TSP solver failed."}
 
+# Solved routes are cached on disk so restarts skip the Google API calls and the solve
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
 
-def convert_types(obj):
+
+def get_cache_path():
+    """
+    Build the cache file path from a hash of the solver inputs.
+    """
+    locations = define_locations()
+    _, _, _, _, flight_time, flight_time_return = define_parameters(locations)
+    key = hashlib.sha1(
+        json.dumps([locations, flight_time, flight_time_return]).encode()
+    ).hexdigest()
+    return os.path.join(CACHE_DIR, f"tsp_{key}.json")
+
+
+def write_tsp_cache(cache_path, result):
+    """
+    Write the TSP result to the disk cache. The cache is only an optimisation, so a
+    failed write is logged and otherwise ignored.
+    """
+    tmp_path = None
+    try:
+        # Write to a temporary file and move it into place, so other workers never
+        # read a partially written cache file
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(result))
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+    except OSError as e:
+        logging.warning("Could not write TSP cache %s: %s", cache_path, e)
+    finally:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def load_or_solve_tsp():
+    """
+    Load the TSP result from the disk cache, or run the solver and cache its result.
+    """
+    cache_path = get_cache_path()
+    try:
+        with open(cache_path, "rb") as f:
+            result = orjson.loads(f.read())
+        result.pop("degraded", None)  # Left by caches written before it was stripped
+        logging.info("Loaded cached TSP result from %s.", cache_path)
+        return result
+    except FileNotFoundError:
+        pass
+    except orjson.JSONDecodeError as e:
+        logging.warning("Discarding unreadable TSP cache %s: %s", cache_path, e)
+        try:
+            os.remove(cache_path)
+        except FileNotFoundError:
+            pass
+
+    result = solve_tsp()
+    # 'degraded' is internal to the solver, so it is neither cached nor served
+    if result.pop("degraded", False):
+        logging.warning("TSP result used fallback API values; not caching it.")
+    elif "error" not in result:
+        write_tsp_cache(cache_path, result)
+    return result
+
+
+def run_tsp_solver():
     """
-    Recursively convert numpy data types to native Python types.
+    Run the TSP solver (or load its cached result), turning failures into an error result.
+    The result never changes afterwards, so it is also encoded to JSON once here.
     """
-    if isinstance(obj, np.integer):
-        return int(obj)
-    elif isinstance(obj, np.floating):
-        return float(obj)
-    elif isinstance(obj, np.ndarray):
-        return obj.tolist()
-    elif isinstance(obj, dict):
-        return {k: convert_types(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_types(item) for item in obj]
-    else:
-        return obj
+    try:
+        logging.info("Starting TSP solver...")
+        result = load_or_solve_tsp()
+        result_json = orjson.dumps(result)
+        logging.info("TSP solver completed successfully.")
+    except Exception as e:
+        logging.error("Error running TSP solver: %s", e)
+        result = {"error": "TSP solver failed."}
+        result_json = orjson.dumps(result)
+    return result, result_json
+
+
+def start_tsp_solver():
+    """
+    Run the TSP solver on a daemon thread and return a Future for its result.
+    The thread is a daemon so shutting down does not wait for an unfinished solve.
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(run_tsp_solver())
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="tsp-solver", daemon=True).start()
+    return future
+
+
+# Run the TSP solver in the background on startup so the server accepts requests right away
+tsp_future = start_tsp_solver()
 
 
 @app.route("/")
@@ -65,22 +151,30 @@ def get_tsp_result():
     """
     API endpoint to get the precomputed Traveling Salesman Problem result.
     """
+    if not tsp_future.done():
+        logging.info("TSP result is still being computed.")
+        return jsonify({"status": "computing"}), 503, {"Retry-After": "5"}
+
+    tsp_result, tsp_json = tsp_future.result()
+
     if not tsp_result:
         logging.error("TSP result not available.")
         return jsonify({"error": "TSP result not available."}), 500
 
     if "error" in tsp_result:
-        logging.error(f"TSP Solver Error: {tsp_result['error']}")
+        logging.error("TSP Solver Error: %s", tsp_result["error"])
         return jsonify(tsp_result), 500
 
-    # Convert 'tsp_result' to serializable types without modifying solver.py
-    serializable_result = convert_types(tsp_result)
-
     logging.info("TSP result successfully fetched.")
-    return jsonify(serializable_result), 200
+    return Response(
+        tsp_json,
+        status=200,
+        mimetype="application/json",
+        headers={"Cache-Control": "public, max-age=3600"},
+    )
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5001))
-    logging.info(f"Flask server is running on port {port}.")
+    logging.info("Flask server is running on port %d.", port)
     app.run(host="0.0.0.0", port=port, debug=True)
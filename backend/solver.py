@@ -1,4 +1,6 @@
+import html
 import math
+import re
 import cvxpy as cp
 import numpy as np
 import googlemaps
@@ -6,14 +8,20 @@ import time
 import os
 import dotenv
 import networkx as nx
-from bs4 import BeautifulSoup  # For parsing HTML instructions
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 import logging
 
 # ----------------- Initialization -----------------
 
+# Shared Google Maps client, set by initialize_api(). The cached API helpers below
+# use it so that their caches are keyed on the request arguments alone.
+gmaps_client = None
+
 
 def initialize_api():
+    global gmaps_client
+
     dotenv.load_dotenv()
     API_KEY = os.getenv("GOOGLE_API_KEY")
 
@@ -23,10 +31,10 @@ def initialize_api():
         )
 
     logging.info("Google API Key successfully retrieved.")
-    logging.info("Installed CVXPy Solvers:", cp.installed_solvers())
-    gmaps = googlemaps.Client(key=API_KEY)
+    logging.info("Installed CVXPy Solvers: %s", cp.installed_solvers())
+    gmaps_client = googlemaps.Client(key=API_KEY)
 
-    return gmaps
+    return gmaps_client
 
 
 # ----------------- Data Definition -----------------
@@ -63,39 +71,98 @@ def define_parameters(locations):
     return N, BER_residence, SFO_airport, BER_airport, flight_time, flight_time_return
 
 
+def define_regions(N, BER_residence, SFO_airport):
+    sf_group = list(range(1, SFO_airport + 1))  # San Francisco locations (1-6)
+    berlin_group = [BER_residence] + list(
+        range(SFO_airport + 1, N)
+    )  # Berlin Residence and Berlin locations (7-11)
+
+    return sf_group, berlin_group
+
+
 # ----------------- Utility Functions -----------------
 
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+
 
-def get_directions(gmaps, origin, destination, mode="driving"):
+def strip_html(text):
+    """Strips the HTML tags and entities from a Directions API instruction."""
+    return html.unescape(HTML_TAG_RE.sub("", text))
+
+
+def get_directions(gmaps, stops, mode="driving"):
+    """
+    Fetches the directions along a sequence of stops with a single Directions API request,
+    passing the intermediate stops as waypoints.
+
+    Args:
+        gmaps (googlemaps.Client): The Google Maps client initialized with an API key.
+        stops (tuple): The addresses or place names to visit, in order.
+        mode (str): The travel mode.
+
+    Returns:
+        list: One list of steps per leg (stops[k] -> stops[k + 1]), or None if the request fails.
+    """
     try:
-        result = gmaps.directions(origin, destination, mode=mode, units="metric")
+        result = gmaps.directions(
+            stops[0],
+            stops[-1],
+            waypoints=list(stops[1:-1]),
+            mode=mode,
+            units="metric",
+        )
         if result:
-            return result[0]["legs"][0]["steps"]
+            return [leg["steps"] for leg in result[0]["legs"]]
         else:
-            print(f"Directions API returned no results for {origin} to {destination}")
+            logging.warning(
+                "Directions API returned no results for %s", " -> ".join(stops)
+            )
             return None
     except Exception as e:
-        print(f"Exception during Directions API call: {e}")
+        logging.error("Exception during Directions API call: %s", e)
         return None
 
 
-def get_driving_time(gmaps, origin, destination):
+def get_driving_times(gmaps, group_locations):
+    """
+    Fetches the pairwise driving times between a group of locations with a single
+    Distance Matrix API request.
+
+    Args:
+        gmaps (googlemaps.Client): The Google Maps client initialized with an API key.
+        group_locations (list): The addresses or place names to use as both origins and destinations.
+
+    Returns:
+        tuple: A (len(group_locations), len(group_locations)) matrix of driving times in minutes,
+            and whether any cell fell back to the high cost because the API failed.
+    """
+    n = len(group_locations)
+    times = np.full((n, n), 1e6)  # Assign high cost where the API fails
+    degraded = False
     try:
         result = gmaps.distance_matrix(
-            origins=[origin], destinations=[destination], mode="driving", units="metric"
+            origins=group_locations,
+            destinations=group_locations,
+            mode="driving",
+            units="metric",
         )
-        element = result["rows"][0]["elements"][0]
-        if element["status"] == "OK":
-            duration = element["duration"]["value"]  # in seconds
-            return duration / 60  # Convert to minutes
-        else:
-            print(
-                f"Distance matrix API error between {origin} and {destination}: {element['status']}"
-            )
-            return 1e6  # Assign high cost if API fails
+        for a, row in enumerate(result["rows"]):
+            for b, element in enumerate(row["elements"]):
+                if element["status"] == "OK":
+                    duration = element["duration"]["value"]  # in seconds
+                    times[a, b] = duration / 60  # Convert to minutes
+                else:
+                    degraded = True
+                    logging.warning(
+                        "Distance matrix API error between %s and %s: %s",
+                        group_locations[a],
+                        group_locations[b],
+                        element["status"],
+                    )
     except Exception as e:
-        print(f"Exception during API call: {e}")
-        return 1e6  # Assign high cost if exception occurs
+        logging.error("Exception during API call: %s", e)
+        degraded = True
+    return times, degraded
 
 
 def get_location_coordinates(gmaps, location):
@@ -107,30 +174,87 @@ def get_location_coordinates(gmaps, location):
         location (str): The address or place name to geocode.
 
     Returns:
-        dict: A dictionary containing 'lat' and 'lng' keys with their respective float values.
+        tuple: A dictionary containing 'lat' and 'lng' keys with their respective float values,
+            and whether the coordinates fell back to (0, 0) because the lookup failed.
     """
     try:
         geocode_result = gmaps.geocode(location)
         if not geocode_result:
-            print(f"No geocode results found for location: {location}")
-            return {"lat": 0.0, "lng": 0.0}
+            logging.warning("No geocode results found for location: %s", location)
+            return {"lat": 0.0, "lng": 0.0}, True
 
         # Taking the first result from the geocoding response
         geometry = geocode_result[0].get("geometry", {})
         location_dict = geometry.get("location", {})
         lat = location_dict.get("lat", 0.0)
         lng = location_dict.get("lng", 0.0)
+        degraded = "lat" not in location_dict or "lng" not in location_dict
 
-        return {"lat": lat, "lng": lng}
+        return {"lat": lat, "lng": lng}, degraded
 
     except Exception as e:
-        print(f"Error fetching coordinates for '{location}': {e}")
-        return {"lat": 0.0, "lng": 0.0}
+        logging.error("Error fetching coordinates for '%s': %s", location, e)
+        return {"lat": 0.0, "lng": 0.0}, True
+
+
+def cache_successful_lookups(is_degraded):
+    """
+    Memoizes an API lookup on its arguments, like functools.lru_cache, except that
+    results for which is_degraded(result) is true are not stored, so a failed
+    lookup is retried on the next call instead of replayed.
+    """
+
+    def decorator(func):
+        cache = {}
+
+        @wraps(func)
+        def wrapper(*args):
+            if args in cache:
+                return cache[args]
+            result = func(*args)
+            if not is_degraded(result):
+                cache[args] = result
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+@cache_successful_lookups(lambda result: result[1])
+def get_location_coordinates_cached(location):
+    return get_location_coordinates(gmaps_client, location)
+
+
+def get_all_location_coordinates(locations):
+    """
+    Geocodes every location concurrently.
+
+    Args:
+        locations (list): The addresses or place names to geocode.
+
+    Returns:
+        tuple: A mapping from each location to its {'lat', 'lng'} coordinates,
+            and whether any of the lookups fell back to (0, 0).
+    """
+    with ThreadPoolExecutor(max_workers=len(locations)) as executor:
+        results = list(executor.map(get_location_coordinates_cached, locations))
+    coords = {
+        location: coordinates for location, (coordinates, _) in zip(locations, results)
+    }
+    degraded = any(location_degraded for _, location_degraded in results)
+    return coords, degraded
+
+
+@cache_successful_lookups(lambda result: result is None)
+def get_directions_cached(stops, mode="driving"):
+    return get_directions(gmaps_client, stops, mode)
 
 
-@lru_cache(maxsize=None)
-def get_location_coordinates_cached(gmaps, location):
-    return get_location_coordinates(gmaps, location)
+@cache_successful_lookups(lambda result: result[1])
+def get_driving_times_cached(group_locations):
+    return get_driving_times(gmaps_client, list(group_locations))
 
 
 # ----------------- Cost Matrix Construction -----------------
@@ -141,44 +265,60 @@ def initialize_cost_matrix(N):
 
 
 def populate_cost_matrix(
-    C, locations, N, gmaps, BER_residence, SFO_airport, BER_airport, flight_time
+    C,
+    locations,
+    N,
+    BER_residence,
+    SFO_airport,
+    BER_airport,
+    flight_time,
+    flight_time_return,
 ):
-    for i in range(N):
-        for j in range(N):
-            if i == j:
-                C[i][j] = 1e6
-            else:
-                if (i < 6 and j < 6) or (i >= 6 and j >= 6):
-                    driving_time = get_driving_time(gmaps, locations[i], locations[j])
-                    C[i][j] = driving_time
-                    print(
-                        f"Driving time from {locations[i]} to {locations[j]}: {driving_time} minutes"
-                    )
-                elif (i == BER_residence and j >= 6) or (i >= 6 and j == BER_residence):
-                    C[i][j] = 10000  # High cost for intercontinental travel
-                    print(
-                        f"Setting high cost for intercontinental travel from {locations[i]} to {locations[j]}: 10000 minutes"
-                    )
-                elif (i == SFO_airport and j == BER_airport) or (
-                    i == BER_airport and j == SFO_airport
-                ):
-                    C[i][j] = flight_time
-                    print(
-                        f"Setting flight time between {locations[i]} and {locations[j]}: {flight_time} minutes"
-                    )
-                else:
-                    C[i][j] = 10000  # High cost for intercontinental travel
-                    print(
-                        f"Setting high cost for intercontinental travel from {locations[i]} to {locations[j]}: 10000 minutes"
-                    )
-    return C
+    sf_group, berlin_group = define_regions(N, BER_residence, SFO_airport)
+
+    # Driving times within each city, one Distance Matrix request per city, issued concurrently
+    groups = (sf_group, berlin_group)
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        results = list(
+            executor.map(
+                lambda group: get_driving_times_cached(
+                    tuple(locations[i] for i in group)
+                ),
+                groups,
+            )
+        )
+    degraded = False
+    for group, (driving_times, group_degraded) in zip(groups, results):
+        C[np.ix_(group, group)] = driving_times
+        degraded = degraded or group_degraded
+        logging.debug(
+            "Driving times between %s:\n%s",
+            [locations[i] for i in group],
+            driving_times,
+        )
+
+    # High cost for intercontinental travel
+    C[np.ix_(sf_group, berlin_group)] = 10000
+    C[np.ix_(berlin_group, sf_group)] = 10000
+
+    # Flights between the airports
+    C[SFO_airport, BER_airport] = flight_time
+    C[BER_airport, SFO_airport] = flight_time_return
+
+    np.fill_diagonal(C, 1e6)
+    return C, degraded
 
 
 def verify_cost_matrix(C, BER_airport, SFO_airport):
-    print("\n--- Cost Matrix Verification ---")
-    print(f"C[{BER_airport}][{SFO_airport}] = {C[BER_airport][SFO_airport]}")
-    print(f"C[{SFO_airport}][{BER_airport}] = {C[SFO_airport][BER_airport]}")
-    print("--- End of Verification ---\n")
+    logging.debug(
+        "Cost Matrix Verification: C[%d][%d] = %s, C[%d][%d] = %s",
+        BER_airport,
+        SFO_airport,
+        C[BER_airport][SFO_airport],
+        SFO_airport,
+        BER_airport,
+        C[SFO_airport][BER_airport],
+    )
 
 
 # ----------------- Optimization Model -----------------
@@ -194,21 +334,12 @@ def define_tsp_model(C, N, sf_nodes, berlin_nodes, locations):
     penalty_weight = 1e4
 
     # Add penalties for undesired connections
-    for i in range(N):
-        for j in range(N):
-            if i in sf_nodes and j in berlin_nodes:
-                penalty_matrix[i, j] = penalty_weight
-                print(
-                    f"Adding penalty for connecting {locations[i]} to {locations[j]}: {penalty_weight}"
-                )
-            if i in berlin_nodes and j in sf_nodes:
-                penalty_matrix[i, j] = penalty_weight
-                print(
-                    f"Adding penalty for connecting {locations[i]} to {locations[j]}: {penalty_weight}"
-                )
+    penalty_matrix[np.ix_(sf_nodes, berlin_nodes)] = penalty_weight
+    penalty_matrix[np.ix_(berlin_nodes, sf_nodes)] = penalty_weight
 
-    # Combined Objective
-    objective = cp.Minimize(cp.sum(cp.multiply(C + penalty_matrix, X)))
+    # Combined Objective, as one dot product over the column-major flattened X
+    weights = (C + penalty_matrix).ravel(order="F")
+    objective = cp.Minimize(weights @ cp.vec(X, order="F"))
 
     return X, U, objective
 
@@ -216,97 +347,163 @@ def define_tsp_model(C, N, sf_nodes, berlin_nodes, locations):
 def define_constraints(X, U, N):
     constraints = []
 
-    # Each city must be entered exactly once
-    for i in range(N):
-        constraints.append(cp.sum(X[:, i]) == 1)
-        constraints.append(cp.sum(X[i, :]) == 1)
+    # Each city must be entered and left exactly once
+    constraints.append(cp.sum(X, axis=0) == 1)
+    constraints.append(cp.sum(X, axis=1) == 1)
 
-    # Subtour elimination constraints (MTZ formulation)
-    for i in range(1, N):
-        constraints.append(U[i] >= 1)
-        constraints.append(U[i] <= N - 1)
-        for j in range(1, N):
-            if i != j:
-                constraints.append(U[i] - U[j] + (N) * X[i, j] <= N - 1)
+    # Subtour elimination constraints (MTZ formulation) over nodes 1..N-1,
+    # as a single matrix inequality: U[i] - U[j] + N * X[i, j] <= N - 1 for i != j
+    ones = np.ones(N - 1)
+    constraints.append(U[1:] >= 1)
+    constraints.append(U[1:] <= N - 1)
+    constraints.append(
+        cp.outer(U[1:], ones) - cp.outer(ones, U[1:]) + N * X[1:, 1:]
+        <= (N - 1) + N * np.eye(N - 1)  # The diagonal (i == j) is left unconstrained
+    )
 
     return constraints
 
 
 def solve_tsp_problem(objective, constraints):
     prob = cp.Problem(objective, constraints)
-    prob.solve(solver=cp.GLPK_MI, verbose=True, max_iters=10000)
+    # HiGHS (through scipy.optimize.milp) branch-and-cuts the MTZ model much faster than GLPK_MI
+    prob.solve(solver=cp.SCIPY)
     return prob
 
 
 # ----------------- Route Reconstruction -----------------
 
 
+def is_flight_segment(current_idx, next_idx, SFO_airport, BER_airport):
+    return (current_idx == SFO_airport and next_idx == BER_airport) or (
+        current_idx == BER_airport and next_idx == SFO_airport
+    )
+
+
+def split_route_by_region(route, regions):
+    """
+    Splits a route into maximal stretches of consecutive stops within the same region.
+
+    Args:
+        route (list): The node indices in visiting order.
+        regions (tuple): The node index lists of each region.
+
+    Returns:
+        list: The stretches, each a list of node indices.
+    """
+    region_of = {node: r for r, region in enumerate(regions) for node in region}
+    stretches = []
+    for node in route:
+        if stretches and region_of[node] == region_of[stretches[-1][-1]]:
+            stretches[-1].append(node)
+        else:
+            stretches.append([node])
+    return stretches
+
+
+def walk_route(X_val, start, N):
+    """
+    Follows the selected edges of the solved assignment matrix from a start node.
+
+    Args:
+        X_val (np.ndarray): The (N, N) solved edge matrix, where X_val[i, j] > 0.5 selects edge i -> j.
+        start (int): The node to start the walk from.
+        N (int): The number of nodes.
+
+    Returns:
+        list: The visited node indices in order, stopping early on a missing edge or a loop.
+    """
+    # Successor of every node from a single argmax pass over the rows
+    successors = X_val.argmax(axis=1)
+    has_edge = X_val[np.arange(N), successors] > 0.5
+
+    route = np.empty(N, dtype=np.int64)
+    visited = np.zeros(N, dtype=bool)
+    route[0] = start
+    visited[start] = True
+    current_node = start
+    length = 1
+
+    while length < N:
+        next_node = int(successors[current_node])
+        if not has_edge[current_node]:
+            logging.error("No outgoing edge from node %d.", current_node)
+            break
+        if visited[next_node]:
+            logging.error("Detected a loop at node %d.", next_node)
+            break
+        route[length] = next_node
+        visited[next_node] = True
+        current_node = next_node
+        length += 1
+
+    return route[:length].tolist()
+
+
 def reconstruct_route(
-    prob, X, locations, gmaps, N, BER_residence, BER_airport, SFO_airport, C
+    prob, X, locations, coords, N, BER_residence, BER_airport, SFO_airport, C
 ):
-    print("Status:", prob.status)
+    logging.info("Solver status: %s", prob.status)
     if prob.status == cp.OPTIMAL:
-        print("Solution found:")
-        print("Route:")
         X_val = X.value
         if X_val is None:
-            print("No solution found.")
+            logging.error("No solution found.")
         else:
-            route = [BER_residence]
-            current_node = BER_residence
-            visited = set(route)
-
-            while len(route) < N:
-                next_nodes = np.where(X_val[current_node] > 0.5)[0]
-                if len(next_nodes) == 0:
-                    print(f"Error: No outgoing edge from node {current_node}.")
-                    break
-                next_node = next_nodes[0]
-                if next_node in visited:
-                    print(f"Error: Detected a loop at node {next_node}.")
-                    break
-                route.append(next_node)
-                visited.add(next_node)
-                current_node = next_node
+            route = walk_route(X_val, BER_residence, N)
+            current_node = route[-1]
 
             # Ensure the route returns to Berlin Residence
-            if X_val[current_node][BER_residence] > 0.5:
+            if X_val[current_node, BER_residence] > 0.5:
                 route.append(BER_residence)
             else:
-                print("Error: Route does not return to the starting point.")
+                logging.error("Route does not return to the starting point.")
 
-            print("\n--- Reconstructed Route ---")
             for idx, node in enumerate(route):
-                print(f"Step {idx}: {locations[node]} (Index {node})")
-            print("--- End of Route ---\n")
+                logging.debug("Step %d: %s (Index %d)", idx, locations[node], node)
 
         optimal_travel_time = prob.value  # Get the optimal travel time from the solver
-        print(
-            "Optimal Value (Total Travel Time in minutes from Solver):",
+        logging.info(
+            "Optimal Value (Total Travel Time in minutes from Solver): %s",
             optimal_travel_time,
         )
 
-        print("\n--------------------------------------------------")
-        print("Detailed Route and Directions:")
-        print("--------------------------------------------------\n")
-
         directions_list = []
         total_travel_time = 0
         local_travel_time = 0
         flight_time_total = 0
 
-        for i in range(len(route) - 1):
-            current_idx = route[i]
-            next_idx = route[i + 1]
-
-            # Check if this is a flight segment
-            is_flight = (current_idx == SFO_airport and next_idx == BER_airport) or (
-                current_idx == BER_airport and next_idx == SFO_airport
+        # Fetch the directions for each same-city stretch of the route with one
+        # waypoint request, issuing the stretches concurrently
+        segments = list(zip(route[:-1], route[1:]))
+        stretches = [
+            stretch
+            for stretch in split_route_by_region(
+                route, define_regions(N, BER_residence, SFO_airport)
+            )
+            if len(stretch) > 1
+        ]
+        with ThreadPoolExecutor(max_workers=max(len(stretches), 1)) as executor:
+            stretch_legs = list(
+                executor.map(
+                    lambda stretch: get_directions_cached(
+                        tuple(locations[idx] for idx in stretch)
+                    ),
+                    stretches,
+                )
             )
 
-            if is_flight:
+        # A stretch without directions falls back to estimated times
+        directions_degraded = any(legs is None for legs in stretch_legs)
+
+        segment_directions = {}
+        for stretch, legs in zip(stretches, stretch_legs):
+            if legs:
+                segment_directions.update(zip(zip(stretch[:-1], stretch[1:]), legs))
+
+        for current_idx, next_idx in segments:
+            if is_flight_segment(current_idx, next_idx, SFO_airport, BER_airport):
                 # Handle flight segment
-                flight_duration = C[current_idx][next_idx]
+                flight_duration = float(C[current_idx, next_idx])
                 flight_time_total += flight_duration
                 total_travel_time += flight_duration
 
@@ -320,17 +517,14 @@ def reconstruct_route(
                 )
             else:
                 # Handle driving segment
-                directions = get_directions(
-                    gmaps, locations[current_idx], locations[next_idx]
-                )
+                directions = segment_directions.get((current_idx, next_idx))
 
                 if directions:
                     segment_duration = 0
                     steps = []
 
                     for step in directions:
-                        soup = BeautifulSoup(step["html_instructions"], "html.parser")
-                        instruction = soup.get_text()
+                        instruction = strip_html(step["html_instructions"])
 
                         step_info = {"instruction": instruction}
 
@@ -379,17 +573,16 @@ def reconstruct_route(
             "total_travel_time_minutes": total_travel_time,
             "local_travel_time_minutes": local_travel_time,
             "flight_time_total_minutes": flight_time_total,
-            "locations": [
-                get_location_coordinates(gmaps, locations[idx]) for idx in route
-            ],
+            "locations": [coords[locations[idx]] for idx in route],
             "SFO_airport_idx": SFO_airport,
             "BER_airport_idx": BER_airport,
             "directions": directions_list,  # Add directions to the response
         }
     else:
         tsp_result = {"error": "No solution found."}
+        directions_degraded = False
 
-    return tsp_result
+    return tsp_result, directions_degraded
 
 
 # ----------------- Solve TSP Function -----------------
@@ -398,7 +591,7 @@ def reconstruct_route(
 def solve_tsp():
     try:
         # Initialization
-        gmaps = initialize_api()
+        initialize_api()
 
         # Data Definition
         locations = define_locations()
@@ -408,11 +601,21 @@ def solve_tsp():
 
         # Cost Matrix Construction
         C = initialize_cost_matrix(N)
-        C = populate_cost_matrix(
-            C, locations, N, gmaps, BER_residence, SFO_airport, BER_airport, flight_time
+        C, cost_matrix_degraded = populate_cost_matrix(
+            C,
+            locations,
+            N,
+            BER_residence,
+            SFO_airport,
+            BER_airport,
+            flight_time,
+            flight_time_return,
         )
         verify_cost_matrix(C, BER_airport, SFO_airport)
 
+        # Location Coordinates
+        coords, coords_degraded = get_all_location_coordinates(locations)
+
         # Define city groups
         sf_nodes = list(range(1, 6))  # SF locations excluding airport
         berlin_nodes = list(range(7, 11))  # Berlin locations excluding airport
@@ -423,12 +626,25 @@ def solve_tsp():
         prob = solve_tsp_problem(objective, constraints)
 
         # Route Reconstruction
-        tsp_result = reconstruct_route(
-            prob, X, locations, gmaps, N, BER_residence, BER_airport, SFO_airport, C
+        tsp_result, directions_degraded = reconstruct_route(
+            prob,
+            X,
+            locations,
+            coords,
+            N,
+            BER_residence,
+            BER_airport,
+            SFO_airport,
+            C,
         )
+        if "error" not in tsp_result:
+            # Tells the caller whether any API lookup fell back to a placeholder value
+            tsp_result["degraded"] = (
+                cost_matrix_degraded or coords_degraded or directions_degraded
+            )
 
         return tsp_result
 
     except Exception as e:
-        logging.error(f"Error in solve_tsp: {e}")
+        logging.error("Error in solve_tsp: %s", e)
         return {"error": "TSP solver failed due to an exception."}
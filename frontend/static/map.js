@@ -13,11 +13,24 @@ function initMap() {
         center: { lat: 37.7749, lng: -122.4194 } // Default center (San Francisco)
     });
 
+    fetchRouteData();
+}
+
+function fetchRouteData() {
     const backendUrl = "/get_tsp_result";
 
     fetch(backendUrl)
-        .then(response => response.json())
+        .then(response => {
+            // The backend answers 503 while the route is still being computed
+            if (response.status === 503) {
+                document.getElementById("route-names-panel").innerHTML = `<h2>Computing optimal route...</h2>`;
+                setTimeout(fetchRouteData, 5000);
+                return null;
+            }
+            return response.json();
+        })
         .then(data => {
+            if (!data) return;
             if (data.error) {
                 alert(data.error);
                 document.getElementById("route-names-panel").innerHTML = `<h2>Error: ${data.error}</h2>`;